@@ -0,0 +1,144 @@
+'''
+ Runs a job in a child process with a wall-clock and memory (RSS) budget, retrying it with degraded settings
+ when the budget is breached
+'''
+import multiprocessing
+import os
+import time
+import warnings
+from queue import Empty
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from tqdm import tqdm
+
+# Outcomes that mean the job went over its budget (and thus is worth retrying with degraded settings)
+BREACH_OUTCOMES = ("timeout", "memory", "crashed")
+
+# The jobs are started from the dispatching threads of joblib: forking there could copy a lock held by another
+# thread (tqdm's one for instance) and deadlock the child, so the children are spawned instead
+_CONTEXT = multiprocessing.get_context("spawn")
+
+
+def _get_rss_mb(pid):
+    """
+    Read the resident set size of a process from /proc
+    :param pid: The pid of the process
+    :return: The RSS in MB, or None if it cannot be read (process gone or non-Linux box)
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            rss_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return rss_pages * os.sysconf("SC_PAGE_SIZE") / (1024 ** 2)
+
+
+def _budgeted_target(queue, func, args, kwargs, max_address_space):
+    if max_address_space and resource is not None:
+        # opt-in backstop for the allocations that happen between two RSS polls: they raise a MemoryError.
+        # It caps virtual memory, so it needs a lot of headroom over the RSS budget
+        max_bytes = int(max_address_space * 1024 ** 2)
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+    try:
+        result = func(*args, **kwargs)
+        queue.put(("ok" if result is not None else "no_result", result))
+    except MemoryError as e:
+        queue.put(("memory", str(e)))
+    except Exception as e:
+        queue.put(("error", str(e)))
+
+
+def run_with_budget(func, args=(), kwargs=None, timeout=None, max_memory=None, max_address_space=None,
+                    poll_interval=0.5):
+    """
+    Run func(*args, **kwargs) in a child process and kill it if it goes over its budget
+    :param func: The function to run. It must be picklable (a module level function), as the child is spawned
+    :param timeout: Wall-clock budget in seconds. None means no limit
+    :param max_memory: RSS budget in MB. None means no limit
+    :param max_address_space: Hard limit (RLIMIT_AS) on the virtual memory of the child in MB. None means no limit
+    :param poll_interval: Seconds between two checks of the child process
+    :return: A tuple (outcome, result). outcome is one of "ok", "no_result", "error", "timeout", "memory",
+     "crashed"
+    """
+    queue = _CONTEXT.Queue()
+    process = _CONTEXT.Process(target=_budgeted_target, args=(queue, func, args, kwargs or {}, max_address_space),
+                               daemon=True)
+    process.start()
+    start = time.time()
+    outcome, result = None, None
+    rss_warned = False
+    while outcome is None:
+        try:
+            outcome, result = queue.get(timeout=poll_interval)
+        except Empty:
+            if not process.is_alive():
+                # the child may have put its result right before exiting
+                try:
+                    outcome, result = queue.get_nowait()
+                except Empty:
+                    # killed by a signal (most likely the OOM killer) vs failed on its own, e.g. at bootstrap
+                    outcome = "crashed" if process.exitcode < 0 else "error"
+                    result = f"child exited with code {process.exitcode}"
+            elif timeout and time.time() - start > timeout:
+                outcome = "timeout"
+            elif max_memory:
+                rss = _get_rss_mb(process.pid)
+                if rss is None and not rss_warned and process.is_alive():
+                    warnings.warn(f"Cannot read the RSS of process {process.pid}, the memory budget is not "
+                                  f"enforced by polling")
+                    rss_warned = True
+                elif rss is not None and rss > max_memory:
+                    outcome = "memory"
+    if process.is_alive():
+        process.terminate()
+    process.join()
+    return outcome, result
+
+
+def run_without_budget(func, args=()):
+    """
+    Run func(*args) in the current process, returning the same record as run_with_degradation
+    :param func: The function to run
+    :return: A dict with the outcome, the degradation level (always 0), the elapsed time and the result of func
+    """
+    start = time.time()
+    try:
+        result = func(*args)
+        outcome = "ok" if result is not None else "no_result"
+    except MemoryError:
+        outcome, result = "memory", None
+    except Exception:
+        outcome, result = "error", None
+    return {"outcome": outcome,
+            "degradation_level": 0,
+            "elapsed": time.time() - start,
+            "result": result if outcome == "ok" else None}
+
+
+def run_with_degradation(func, args=(), degradation_levels=(None,), timeout=None, max_memory=None,
+                         max_address_space=None):
+    """
+    Run a job under a budget, retrying it with the next degradation level each time the budget is breached
+    :param func: The function to run. It must accept a degradation_level keyword argument
+    :param degradation_levels: The list of settings func knows about, from the least to the most degraded
+    :param timeout: Wall-clock budget in seconds, for each try
+    :param max_memory: RSS budget in MB, for each try
+    :param max_address_space: Hard limit on the virtual memory in MB, for each try
+    :return: A dict with the outcome, the degradation level used, the elapsed time and the result of func
+    """
+    start = time.time()
+    for degradation_level in range(len(degradation_levels)):
+        outcome, result = run_with_budget(func, args=args, kwargs={"degradation_level": degradation_level},
+                                          timeout=timeout, max_memory=max_memory,
+                                          max_address_space=max_address_space)
+        if outcome not in BREACH_OUTCOMES:
+            break
+        tqdm.write(f"Budget breached ({outcome}) at degradation level {degradation_level}")
+    return {"outcome": outcome,
+            "degradation_level": degradation_level,
+            "elapsed": time.time() - start,
+            "result": result if outcome == "ok" else None}
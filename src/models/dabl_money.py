@@ -14,6 +14,7 @@ from datetime import datetime
 import os
 
 from src.data.find_ml_candidates import find_interesting_mlearnable_datasets
+from src.models.budget import run_with_degradation, run_without_budget
 
 today = datetime.today().strftime('%d_%m_%Y')
 
@@ -23,11 +24,59 @@ import dabl
 import numpy as np
 import pandas as pd
 from joblib import delayed, Parallel
+from sklearn.base import clone
+from sklearn.linear_model import Lasso, Ridge
+from sklearn.tree import DecisionTreeRegressor
 from tqdm import tqdm
 import json
 
 np.random.seed(42)
 
+# Settings used when a job goes over its budget, from the least to the most degraded:
+# rows kept, dabl estimators tried (None means dabl's fast regressors) and number of buckets for hashing the
+# categorical features. The degraded levels drop the dummy and stump baselines, which can never make the report
+DEGRADATION_LEVELS = [
+    {"sample": None, "estimators": None, "hash_buckets": None},
+    {"sample": 20000, "estimators": [DecisionTreeRegressor(max_depth=5), Ridge(alpha=10), Lasso(alpha=10)],
+     "hash_buckets": None},
+    {"sample": 5000, "estimators": [DecisionTreeRegressor(max_depth=5), Ridge(alpha=10)], "hash_buckets": 32},
+]
+
+
+class RestrictedRegressor(dabl.SimpleRegressor):
+    """
+    A dabl SimpleRegressor that only tries the given estimators (all of dabl's fast regressors if None)
+    """
+    def __init__(self, refit=True, random_state=None, verbose=1, type_hints=None, shuffle=True,
+                 estimators=None):
+        super().__init__(refit=refit, random_state=random_state, verbose=verbose, type_hints=type_hints,
+                         shuffle=shuffle)
+        self.estimators = estimators
+
+    def _get_estimators(self):
+        if self.estimators is None:
+            return super()._get_estimators()
+        return [clone(est) for est in self.estimators]
+
+
+def hash_categorical(data_clean, data_types, target_col, n_buckets):
+    """
+    Replace the categorical columns by a hash of their values, to bound the number of features. Free string
+    columns are left alone, dabl drops them anyway
+    :param data_clean: The dataframe output of dabl.clean
+    :param data_types: The types detected by dabl.clean
+    :param target_col: The target column, it is left untouched
+    :param n_buckets: The number of distinct values kept per column
+    :return: A copy of data_clean with the hashed columns
+    """
+    data_hashed = data_clean.copy()
+    for col in data_types[data_types['categorical']].index:
+        if col == target_col or col not in data_hashed:
+            continue
+        hashes = pd.util.hash_pandas_object(data_hashed[col].astype(str), index=False) % n_buckets
+        data_hashed[col] = ("h" + hashes.astype(str)).astype("category")
+    return data_hashed
+
 
 def get_files(input_folder, ext=".csv", n_sample=0):
     list_files = []
@@ -61,7 +110,8 @@ def load_csv_detective_cache(csv_detective_json: Path):
 
 
 
-def main(csv_file_path: Path, n_jobs: int, csv_detective_path: Path, output_path: Path):
+def main(csv_file_path: Path, n_jobs: int, csv_detective_path: Path, output_path: Path, timeout=None,
+         max_memory=None, max_address_space=None):
     list_files = get_files(csv_file_path)
     # remove dabl analysis files
     list_files = [f for f in list_files if "dabl_" not in str(f)]
@@ -72,19 +122,33 @@ def main(csv_file_path: Path, n_jobs: int, csv_detective_path: Path, output_path
 
     money_list, csv_detective_json = find_interesting_mlearnable_datasets(csv_detective_path)
 
-    job_output = Parallel(n_jobs=n_jobs)(delayed(run)(csv_meta, list_files, output_folder)
-                                         for csv_meta in tqdm(money_list.items()))
+    if timeout or max_memory:
+        # each job runs in its own budgeted (spawned) child process, so threads are enough to dispatch them
+        job_output = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(run_with_degradation)(run, args=(csv_meta, list_files, output_folder),
+                                          degradation_levels=DEGRADATION_LEVELS, timeout=timeout,
+                                          max_memory=max_memory, max_address_space=max_address_space)
+            for csv_meta in tqdm(money_list.items()))
+    else:
+        job_output = Parallel(n_jobs=n_jobs)(delayed(run_without_budget)(run, args=(csv_meta, list_files,
+                                                                                    output_folder))
+                                             for csv_meta in tqdm(money_list.items()))
+
+    budget_log = pd.DataFrame([{"csv_id": csv_id, **{k: v for k, v in j.items() if k != "result"}}
+                               for csv_id, j in zip(money_list, job_output)])
+    budget_log.to_csv(output_folder / "_budget_log.csv", header=True, index=False)
 
-    clean_output = [j for j in job_output if j]
+    clean_output = [j["result"] for j in job_output if j["result"]]
     nb_analyzed = len(clean_output)
 
     tqdm.write(f"We tried {len(list_files)} csv files, we could do at least one dabl model in {nb_analyzed}"
                f" files.")
 
 
-def run(csv_metadata, list_files, output_folder):
+def run(csv_metadata, list_files, output_folder, degradation_level=0):
     csv_id = csv_metadata[0]
     csv_metadata = csv_metadata[1]
+    degradation = DEGRADATION_LEVELS[degradation_level]
 
     tqdm.write(f"\nTreating {csv_id} file")
 
@@ -114,6 +178,8 @@ def run(csv_metadata, list_files, output_folder):
         # remove csv_detective columns
         #data = data.drop(csv_detective_columns, axis=1)
         # TODO change this as now the columns are not in the same order
+        if degradation["sample"]:
+            data = data.sample(n=min(degradation["sample"], len(data)), random_state=42)
 
         data_clean, data_types = dabl.clean(data, return_types=True, verbose=3)
         # dabl.detect_types(data)
@@ -123,8 +189,12 @@ def run(csv_metadata, list_files, output_folder):
                 data_clean_no_nan = data_clean[data_clean[target_col].notna()]
                 if len(data_clean_no_nan) < 100:  # less than 100 examples is too few examples
                     continue
+                if degradation["hash_buckets"]:
+                    data_clean_no_nan = hash_categorical(data_clean_no_nan, data_types, target_col,
+                                                         degradation["hash_buckets"])
                 print(f"Building models with target variable: {target_col}")
-                sc = dabl.SimpleRegressor(random_state=42).fit(data_clean_no_nan, target_col=target_col)
+                sc = RestrictedRegressor(random_state=42, estimators=degradation["estimators"])
+                sc = sc.fit(data_clean_no_nan, target_col=target_col)
                 features_names = sc.est_.steps[0][1].get_feature_names()
                 inner_dict = {"csv_id": csv_id, "task": "regression",
                               "algorithm": sc.current_best_.name,
@@ -133,14 +203,19 @@ def run(csv_metadata, list_files, output_folder):
                               "features_names": "|".join(features_names),
                               "nb_classes": len(data[target_col].unique()),
                               "nb_lines": data_clean_no_nan.shape[0],
+                              "degradation_level": degradation_level,
                               "date": today,
                               }
 
                 inner_dict.update(sc.current_best_.to_dict())
                 inner_dict.update({"avg_scores": np.mean(list(sc.current_best_.to_dict().values()))})
                 result_list.append(inner_dict)
+            except MemoryError:
+                raise  # let the budget executor retry with degraded settings
             except Exception as e:
                 tqdm.write(f"Could not analyze file {csv_id} with target col {target_col}. Error {str(e)}")
+    except MemoryError:
+        raise
     except Exception as e:
         tqdm.write(f"Could not analyze file {csv_id}. Error: {e}")
         return None
@@ -159,6 +234,13 @@ if __name__ == '__main__':
     parser.add_argument('--json_path')
     parser.add_argument('--num_cores',
                         default='1')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Wall-clock budget of each job, in seconds')
+    parser.add_argument('--max_memory', type=float, default=None,
+                        help='Memory (RSS) budget of each job, in MB')
+    parser.add_argument('--max_address_space', type=float, default=None,
+                        help='Optional hard limit (RLIMIT_AS) on the virtual memory of each budgeted job, in MB. '
+                             'Keep it several times --max_memory, numpy/sklearn reserve much more than they use')
 
     args = parser.parse_args()
 
@@ -167,5 +249,6 @@ if __name__ == '__main__':
     csv_detective_path = Path(args.json_path)
     n_jobs = int(args.num_cores)
 
-    main(raw_csv_path, n_jobs, csv_detective_path, output_folder)
+    main(raw_csv_path, n_jobs, csv_detective_path, output_folder, timeout=args.timeout, max_memory=args.max_memory,
+         max_address_space=args.max_address_space)
 
@@ -0,0 +1,195 @@
+'''
+ Builds a ranked leaderboard of the most mlearnable datasets out of the _dabl.csv files of the dabl sweeps.
+ dabl_money writes them in its output folder while dabl_dgf writes them next to the csv files, so pass both folders.
+
+ Only the report columns are parsed (projection), but CSV has no row statistics to skip on: the score and nb_lines
+ filters are applied to each file right after it is read, before the files are concatenated.
+
+Usage:
+    python -m src.models.report --results_folders data/output data/csv --min_score 0.75 --max_score 0.98
+'''
+import argparse
+import json
+import time
+from pathlib import Path
+
+import pandas as pd
+from joblib import delayed, Parallel
+from tqdm import tqdm
+
+# The score used to rank each task: the mean of these columns of the dabl output
+TASK_SCORES = {"regression": ["r2"],
+               "classification": ["f1_macro", "roc_auc"]}
+
+# Only these columns are read from the dabl outputs (features_names and the like are left out)
+REPORT_COLUMNS = ["csv_id", "task", "algorithm", "target_col", "nb_features", "nb_classes", "nb_lines",
+                  "degradation_level", "date", "avg_scores"] + sorted({s for v in TASK_SCORES.values() for s in v})
+
+# A file must have these columns and at least one score column to be part of the report
+REQUIRED_COLUMNS = ["task", "nb_lines"]
+SCORE_COLUMNS = ["avg_scores"] + sorted({s for v in TASK_SCORES.values() for s in v})
+
+REPORT_NAME = "dabl_report.csv"
+
+
+def load_report_state(state_path: Path):
+    """
+    Load the thresholds, the results folders and the scan start time of the last report
+    :param state_path: Path of the JSON file written next to the report
+    :return: The state dict, or an empty dict if there is no usable one
+    """
+    if not state_path.exists():
+        return {}
+    try:
+        with open(state_path.as_posix()) as state_file:
+            return json.load(state_file)
+    except Exception:
+        return {}
+
+
+def get_result_files(results_folders):
+    """
+    List the dabl outputs of the sweeps
+    :param results_folders: The folders to search, recursively (the dabl_money output folder, the csv folder of
+    dabl_dgf)
+    :return: The sorted list of absolute _dabl.csv paths, so that a file has the same path whatever the way the
+    folders were given
+    """
+    return sorted({f.resolve() for folder in results_folders for f in Path(folder).glob("**/*_dabl.csv")})
+
+
+def get_score(results: pd.DataFrame):
+    """
+    Compute the ranking score of each row, according to its task
+    :param results: A dataframe of dabl results
+    :return: A series with the score of each row
+    """
+    score = results["avg_scores"].copy() if "avg_scores" in results else pd.Series(float("nan"), results.index)
+    for task, score_columns in TASK_SCORES.items():
+        score_columns = [c for c in score_columns if c in results]
+        if not score_columns:
+            continue
+        is_task = results["task"] == task
+        score[is_task] = results.loc[is_task, score_columns].mean(axis=1)
+    return score
+
+
+def scan(result_file: Path, min_score: float, max_score: float, min_lines: int):
+    """
+    Read a single dabl output, keeping only the report columns and the rows above the thresholds
+    :param result_file: The _dabl.csv path
+    :param min_score: Rows with a lower score are dropped
+    :param max_score: Rows with a higher score are flagged as a probable leakage
+    :param min_lines: Rows trained with fewer lines are dropped
+    :return: The filtered dataframe, or None if the file cannot be read or is not a dabl output
+    """
+    try:
+        results = pd.read_csv(result_file, usecols=lambda c: c in REPORT_COLUMNS)
+    except Exception as e:
+        tqdm.write(f"Could not read {result_file}. Error: {e}")
+        return None
+    missing_columns = [c for c in REQUIRED_COLUMNS if c not in results]
+    if missing_columns or not any(c in results for c in SCORE_COLUMNS):
+        tqdm.write(f"Skipping {result_file}: it is not a dabl output (missing columns {missing_columns} "
+                   f"or no score column)")
+        return None
+    results["score"] = get_score(results)
+    results = results[(results["score"] >= min_score) & (results["nb_lines"] >= min_lines)]
+    return results.assign(leakage=results["score"] > max_score, result_file=result_file.as_posix())
+
+
+def rank(report: pd.DataFrame):
+    """
+    Sort the report by task and by score, leaking rows last, and number the rows within each task
+    :param report: The concatenated filtered results
+    :return: The ranked report
+    """
+    report = report.sort_values(["task", "leakage", "score", "nb_lines"], ascending=[True, True, False, False])
+    report["rank"] = report.groupby("task").cumcount() + 1
+    return report.reset_index(drop=True)
+
+
+def main(results_folders, report_path: Path, n_jobs: int, min_score=0.75, max_score=0.98, min_lines=100,
+         full=False):
+    state_path = report_path.with_suffix(".json")
+    thresholds = {"min_score": min_score, "max_score": max_score, "min_lines": min_lines}
+    folders = sorted(Path(f).resolve().as_posix() for f in results_folders)
+    state = load_report_state(state_path)
+    if state and state.get("thresholds") != thresholds and not full:
+        tqdm.write(f"The thresholds changed since the last report ({state.get('thresholds')}), rescanning everything")
+        full = True
+    if state and state.get("results_folders") != folders and not full:
+        # the older files of a newly given folder would never be scanned otherwise
+        tqdm.write(f"The results folders changed since the last report ({state.get('results_folders')}), "
+                   f"rescanning everything")
+        full = True
+
+    previous_report = None
+    last_report_time = 0.0
+    if report_path.exists() and state and not full:
+        previous_report = pd.read_csv(report_path)
+        last_report_time = state["scan_start"]
+
+    # files written while we scan are newer than this, so the next report picks them up
+    scan_start = time.time()
+    all_files = get_result_files(results_folders)
+    list_files = [f for f in all_files if f.stat().st_mtime > last_report_time]
+    nb_gone = 0
+    if previous_report is not None:
+        # rows of the files that were deleted or moved since the last report are dropped
+        gone = ~previous_report["result_file"].isin({f.as_posix() for f in all_files})
+        nb_gone = gone.sum()
+        if nb_gone:
+            tqdm.write(f"Dropping {nb_gone} models of dabl outputs that no longer exist")
+            previous_report = previous_report[~gone]
+    if previous_report is not None and not list_files and not nb_gone:
+        tqdm.write(f"No dabl output newer than {report_path}, nothing to update")
+        return previous_report
+
+    job_output = Parallel(n_jobs=n_jobs)(delayed(scan)(f, min_score, max_score, min_lines)
+                                         for f in tqdm(list_files))
+    new_results = [j for j in job_output if j is not None and not j.empty]
+
+    if previous_report is not None:
+        # rows of the files that were written again since the last report are replaced
+        updated_files = {f.as_posix() for f in list_files}
+        new_results.append(previous_report[~previous_report["result_file"].isin(updated_files)])
+    if not new_results:
+        tqdm.write(f"No dabl result above {min_score} in {', '.join(map(str, results_folders))}")
+        return None
+
+    report = rank(pd.concat(new_results, axis=0, ignore_index=True, sort=False))
+    report.to_csv(report_path, header=True, index=False)
+    with open(state_path.as_posix(), "w") as state_file:
+        json.dump({"thresholds": thresholds, "results_folders": folders, "scan_start": scan_start}, state_file,
+                  indent=4)
+
+    tqdm.write(f"We scanned {len(list_files)} dabl outputs, {len(report)} models (of which "
+               f"{report['leakage'].sum()} probably leaking) are in {report_path}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results_folders', nargs='+',
+                        help='Folders with the dabl outputs: the output folder of dabl_money and/or the csv folder '
+                             'of dabl_dgf')
+    parser.add_argument('--report_path', default=None,
+                        help=f'Where to write the leaderboard [default: <first results folder>/{REPORT_NAME}]')
+    parser.add_argument('--min_score', type=float, default=0.75)
+    parser.add_argument('--max_score', type=float, default=0.98,
+                        help='Models scoring more than this are flagged as a probable leakage')
+    parser.add_argument('--min_lines', type=int, default=100)
+    parser.add_argument('--full', action='store_true',
+                        help='Rescan every dabl output, even the ones older than the last report')
+    parser.add_argument('--num_cores',
+                        default='1')
+
+    args = parser.parse_args()
+
+    results_folders = [Path(f) for f in args.results_folders]
+    report_path = Path(args.report_path) if args.report_path else results_folders[0] / REPORT_NAME
+    n_jobs = int(args.num_cores)
+
+    main(results_folders, report_path, n_jobs, min_score=args.min_score, max_score=args.max_score,
+         min_lines=args.min_lines, full=args.full)